@@ -3,21 +3,27 @@
 from __future__ import annotations
 
 import logging
-import shelve
 import time
-from typing import Union
+from typing import Optional, Union
 import asyncio
 import json
+import random
+from functools import partial
 
 from aiogram import Bot, Dispatcher, types, loggers
 from aiogram import exceptions
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters.command import Command
 from aiogram.utils.serialization import deserialize_telegram_object_to_python
 
 from .lib.expiringdict import ExpiringDict
+from .store import ConfigStore
 
 logger = logging.getLogger(__name__)
 
+_MEMBER_STATUSES = frozenset({'member', 'creator', 'administrator'})
+_GROUP_TYPES = frozenset({'group', 'supergroup'})
+
 NEWPAIR_USAGE = '''\
 Usage: /newpair @front @group
 
@@ -29,16 +35,38 @@ class ChatUnavailable(Exception):
   def __init__(self, chat_id: Union[str, int]) -> None:
     self.chat_id = chat_id
 
+class _LazyJson:
+  # serialized only if a handler actually emits the record
+  def __init__(self, obj) -> None:
+    self._obj = obj
+
+  def __str__(self) -> str:
+    return json.dumps(
+      deserialize_telegram_object_to_python(self._obj),
+      ensure_ascii = False,
+    )
+
 class SpamFightBot:
   def __init__(self, store, token):
     self.store = store
-    store['front_groups'] = {g for g in store.values() if isinstance(g, int)}
+    # materialized once at startup; kept up to date incrementally
+    self._front_groups = store.front_groups()
     self.newuser_msgs = ExpiringDict(300, maxsize=100)
     # we banned a member for 60s so in 50s whatever we receive is missed
     # and shoud be deleted
     self.just_banned = ExpiringDict(50, maxsize=100)
-
-    bot = Bot(token=token)
+    # avoid repeated API round-trips when a /newpair is retried shortly
+    self.chat_cache = ExpiringDict(60, maxsize=256)
+    self.admins_cache = ExpiringDict(30, maxsize=256)
+
+    session = AiohttpSession()
+    # fanned-out deletions shouldn't queue behind a tiny connection pool
+    session._connector_init.update(
+      limit = 50,
+      limit_per_host = 50,
+      keepalive_timeout = 75,
+    )
+    bot = Bot(token=token, session=session)
     dp = Dispatcher()
 
     dp.message(Command('newpair'))(self.newpair)
@@ -48,77 +76,125 @@ class SpamFightBot:
     self.bot = bot
 
   async def newpair(self, msg):
-    bot = self.bot
     u = msg.from_user
     logger.debug('newpair msg: %r', msg.text)
 
-    if msg.chat.type in ["group", "supergroup"]:
+    if msg.chat.type in _GROUP_TYPES:
       try:
         await msg.delete()
       except exceptions.TelegramAPIError:
         pass
       return
 
-    reply = await self.newpair_impl(bot, msg, u)
-    await bot.send_message(
-      u.id,
-      text = reply,
-      reply_to_message_id = msg.message_id,
-    )
+    reply = await self.newpair_impl(msg, u)
+    await msg.reply(reply)
+
+  async def get_chat_or_fail(self, chat_id: Union[int, str]) -> types.Chat:
+    self.chat_cache.expire()
+    try:
+      chat = self.chat_cache[chat_id]
+    except KeyError:
+      pass
+    else:
+      if chat is None:
+        raise ChatUnavailable(chat_id)
+      return chat
 
-  async def newpair_impl(self, bot, msg, u) -> str:
+    try:
+      chat = await self.bot.get_chat(chat_id)
+    except exceptions.TelegramAPIError:
+      # remember dead chats too so retries don't re-probe them
+      self.chat_cache[chat_id] = None
+      raise ChatUnavailable(chat_id)
+    self.chat_cache[chat_id] = chat
+    return chat
+
+  async def get_chat_administrators(self, chat_id: Union[int, str]) -> list:
+    self.admins_cache.expire()
+    try:
+      return self.admins_cache[chat_id]
+    except KeyError:
+      admins = await self.bot.get_chat_administrators(chat_id)
+      self.admins_cache[chat_id] = admins
+      return admins
+
+  async def newpair_impl(self, msg, u) -> str:
     try:
       _, front, group = msg.text.split()
     except ValueError:
       return NEWPAIR_USAGE
 
+    # reject obviously invalid references without spending API calls
+    if not all(
+      (c.startswith('@') and len(c) > 1) or c.lstrip('-').isdigit()
+      for c in (front, group)
+    ):
+      return NEWPAIR_USAGE
+
     try:
-      front_g = await get_chat_or_fail(bot, front)
-      group_g = await get_chat_or_fail(bot, group)
+      front_g, group_g = await asyncio.gather(
+        self.get_chat_or_fail(front),
+        self.get_chat_or_fail(group),
+      )
     except ChatUnavailable as e:
       return f'Error: the chat {e.chat_id} does not exist or is unavailable to me.'
 
-    if group_g.type not in ['group', 'supergroup']:
+    if group_g.type not in _GROUP_TYPES:
       return f'Error: {group} is not a group.'
 
-    admins = await bot.get_chat_administrators(group)
-    admin_ids = [cm.user.id for cm in admins]
+    if front_g.type == 'channel':
+      # the channel check is independent; overlap it with the group one
+      admins, front_admins = await asyncio.gather(
+        self.get_chat_administrators(group),
+        self.get_chat_administrators(front),
+        return_exceptions = True,
+      )
+      if isinstance(admins, BaseException):
+        raise admins
+    else:
+      admins = await self.get_chat_administrators(group)
+      front_admins = None
+
+    admin_ids = {cm.user.id for cm in admins}
     if u.id not in admin_ids:
       return f'Error: you are not an admin of {group}.'
 
-    if bot.id not in admin_ids:
+    if self._me.id not in admin_ids:
       return f"Error: I'm not an admin of {group}."
 
-    if front_g.type == 'channel':
-      try:
-        await bot.get_chat_administrators(front)
-      except exceptions.TelegramBadRequest: # Member list is inaccessible
-        return f"Error: I'm not an admin of {front_g.type} {front} but I need to be in order to see its members."
+    if isinstance(front_admins, exceptions.TelegramBadRequest): # Member list is inaccessible
+      return f"Error: I'm not an admin of {front_g.type} {front} but I need to be in order to see its members."
+    elif isinstance(front_admins, BaseException):
+      raise front_admins
 
-    self.store['front_groups'] = {g for g in self.store.values() if isinstance(g, int)}
-    self.store[str(group_g.id)] = front_g.id
+    self._front_groups.add(front_g.id)
+    await self.store.set(group_g.id, front_g.id)
+    self.admins_cache.pop(group, None)
     logger.info('new pair: %s and %s', front, group)
     return 'Success!'
 
   async def on_message(self, msg: types.Message) -> None:
     try:
       if logger.isEnabledFor(logging.DEBUG):
-        msg_str = json.dumps(deserialize_telegram_object_to_python(msg), ensure_ascii=False)
-        logger.debug('Message: %s', msg_str)
+        logger.debug('Message: %s', _LazyJson(msg))
       await self._on_message_real(msg)
     except exceptions.TelegramAPIError as e:
       logger.info('Leaving %s (%d) (%r)', msg.chat.title, msg.chat.id, e)
       await self.bot.leave_chat(msg.chat.id)
-      try:
-        del self.store[str(msg.chat.id)]
-      except KeyError:
-        pass
+      await self.store.delete(msg.chat.id)
 
   async def _on_message_real(self, msg: types.Message) -> None:
     bot = self.bot
 
-    self.just_banned.expire()
     key = msg.from_user.id, msg.chat.id
+    if not (
+      msg.new_chat_members or msg.left_chat_member
+      or key in self.just_banned or key in self.newuser_msgs
+    ):
+      # routine chatter: skip the expiry sweeps
+      return
+
+    self.just_banned.expire()
     if key in self.just_banned:
       logger.info('Missed message, deleting: %s', msg.text)
       await bot.delete_message(msg.chat.id, msg.message_id)
@@ -132,30 +208,32 @@ class SpamFightBot:
       known_msgs.append(msg.message_id)
 
     if msg.left_chat_member:
-      if self.bot_id == msg.left_chat_member.id:
+      if self._me.id == msg.left_chat_member.id:
         # I'm removed
-        try:
-          logger.info('Leaving %s (%d) (self removed)', msg.chat.title, msg.chat.id)
-          del self.store[str(msg.chat.id)]
-        except KeyError:
-          pass
+        logger.info('Leaving %s (%d) (self removed)', msg.chat.title, msg.chat.id)
+        await self.store.delete(msg.chat.id)
 
-      elif self.bot_id == msg.from_user.id:
+      elif self._me.id == msg.from_user.id:
         # I've removed the user
-        await bot.delete_message(msg.chat.id, msg.message_id)
+        await _call_with_retry(partial(
+          bot.delete_message, msg.chat.id, msg.message_id))
 
     if not msg.new_chat_members:
       return
 
+    group_id = msg.chat.id
+    # one store lookup per message, not per joined member
+    front_id = self.store.get(group_id)
+
     for u in msg.new_chat_members:
       if u.is_bot:
         continue
-      logger.info('new user: %s (%d) in %s', u.full_name, u.id, msg.chat.title)
+      # full_name concatenates on each access; resolve it once
+      name = u.full_name
+      logger.info('new user: %s (%d) in %s', name, u.id, msg.chat.title)
 
-      group_id = msg.chat.id
-      front_id = self.store.get(str(group_id))
       if front_id is None:
-        if group_id not in self.store['front_groups']:
+        if group_id not in self._front_groups:
           # leave any unconfigured groups
           logger.info('Leaving %s (%d) (unconfigured)', msg.chat.title, group_id)
           await bot.leave_chat(group_id)
@@ -164,18 +242,20 @@ class SpamFightBot:
       if msg.from_user.id != u.id:
         logger.info(
           '%s added to %s by %s',
-          u.full_name,
+          name,
           msg.chat.title,
           msg.from_user.full_name,
         )
         cm = await bot.get_chat_member(group_id, msg.from_user.id)
-        is_member = cm.status in ['member', 'creator', 'administrator']
+        is_member = cm.status in _MEMBER_STATUSES
       else:
         self.newuser_msgs[key] = []
         try:
           cm = await bot.get_chat_member(front_id, u.id)
-          is_member = cm.status in ['member', 'creator', 'administrator']
-          logger.debug('ChatMember %r', cm)
+          is_member = cm.status in _MEMBER_STATUSES
+          if logger.isEnabledFor(logging.DEBUG):
+            # repr() of the pydantic model isn't cheap
+            logger.debug('ChatMember %r', cm)
         except exceptions.TelegramForbiddenError:
           logger.warning('insuffient permissions for %s for group %s',
                           front_id, msg.chat.title)
@@ -187,52 +267,101 @@ class SpamFightBot:
           is_member = True
 
       if is_member:
-        logger.info('%s joined %s', u.full_name, msg.chat.title)
-        try:
-          del newuser_msgs[key]
-        except KeyError:
-          pass
+        logger.info('%s joined %s', name, msg.chat.title)
+        newuser_msgs.pop(key, None)
       else:
-        logger.info('Removing %s', u.full_name)
+        logger.info('Removing %s', name)
         self.just_banned[key] = True
-        await bot.ban_chat_member(
-          msg.chat.id,
-          u.id,
-          # python-telegram-bot has changed timezone handling silently,
-          # causing blocking people forever
-          # I've switched to aiogram, but I don't want to be bitten again.
-          until_date = int(time.time() + 60),
+        # the ban and the join-message deletion are independent calls
+        ban_r, del_r = await asyncio.gather(
+          _call_with_retry(partial(
+            bot.ban_chat_member,
+            msg.chat.id,
+            u.id,
+            # python-telegram-bot has changed timezone handling silently,
+            # causing blocking people forever
+            # I've switched to aiogram, but I don't want to be bitten again.
+            until_date = int(time.time() + 60),
+          )),
+          _call_with_retry(partial(
+            bot.delete_message, msg.chat.id, msg.message_id)),
+          return_exceptions = True,
         )
-        try:
-          await bot.delete_message(msg.chat.id, msg.message_id)
-        except exceptions.TelegramNotFound:
-          # message deleted by others
-          pass
-
-        # delete received spam message
+        if isinstance(ban_r, BaseException):
+          raise ban_r
+        if isinstance(del_r, BaseException) and \
+           not isinstance(del_r, exceptions.TelegramNotFound):
+          # message deleted by others is fine
+          raise del_r
+
+        # delete received spam messages
         if msgs := newuser_msgs.pop(key, None):
           logger.info(
             'Removing %d messages(s) from %s',
-            len(msgs), u.full_name
+            len(msgs), name,
           )
-          for msg_id in msgs:
-            await bot.delete_message(msg.chat.id, msg_id)
-
-  async def run(self) -> None:
-    self.bot_id = (await self.bot.me()).id
-    await self.bot.delete_webhook(drop_pending_updates=True)
-    await self.dp.start_polling(self.bot)
-
-async def get_chat_or_fail(bot: Bot, chat_id: Union[int, str]) -> types.Chat:
-  try:
-    return await bot.get_chat(chat_id)
-  except exceptions.TelegramAPIError:
-    raise ChatUnavailable(chat_id)
-
-async def main(bot_token, storefile):
-  with shelve.open(storefile) as store:
+          results = await asyncio.gather(
+            *(_call_with_retry(partial(bot.delete_message, msg.chat.id, msg_id))
+              for msg_id in msgs),
+            return_exceptions = True,
+          )
+          for r in results:
+            if isinstance(r, BaseException):
+              logger.warning('failed to delete a spam message: %r', r)
+
+  async def run(
+    self,
+    webhook_url: Optional[str] = None,
+    webhook_port: int = 8080,
+  ) -> None:
+    self._me = await self.bot.me()
+    if webhook_url:
+      # Telegram pushes updates concurrently; no polling latency floor
+      from urllib.parse import urlparse
+      from aiohttp import web
+      from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+      await self.bot.set_webhook(
+        webhook_url,
+        drop_pending_updates = True,
+        allowed_updates = ['message'],
+      )
+      app = web.Application()
+      SimpleRequestHandler(dispatcher=self.dp, bot=self.bot).register(
+        app, path = urlparse(webhook_url).path or '/')
+      runner = web.AppRunner(app)
+      await runner.setup()
+      site = web.TCPSite(runner, '127.0.0.1', webhook_port)
+      await site.start()
+      try:
+        await asyncio.Event().wait()
+      finally:
+        await runner.cleanup()
+    else:
+      await self.bot.delete_webhook(drop_pending_updates=True)
+      await self.dp.start_polling(self.bot, allowed_updates=['message'])
+
+async def _call_with_retry(coro_factory, tries: int = 3):
+  backoff = 1
+  for i in range(tries):
+    try:
+      return await coro_factory()
+    except exceptions.TelegramRetryAfter as e:
+      if i == tries - 1:
+        raise
+      logger.warning('rate limited, retrying in %ds', e.retry_after)
+      await asyncio.sleep(e.retry_after + random.uniform(0, 0.5))
+    except exceptions.TelegramNetworkError as e:
+      if i == tries - 1:
+        raise
+      logger.warning('network error (%r), retrying in %ds', e, backoff)
+      await asyncio.sleep(backoff)
+      backoff *= 2
+
+async def main(bot_token, storefile, webhook_url=None, webhook_port=8080):
+  with ConfigStore(storefile) as store:
     sfbot = SpamFightBot(store, bot_token)
-    await sfbot.run()
+    await sfbot.run(webhook_url, webhook_port)
 
 if __name__ == '__main__':
   import os, sys
@@ -245,6 +374,11 @@ if __name__ == '__main__':
   parser.add_argument('storefile', metavar='FILE',
                       nargs='?', default='spamfightbot.store',
                       help='file path to store some data')
+  parser.add_argument('--webhook-url', metavar='URL',
+                      help='receive updates pushed to URL instead of long-polling')
+  parser.add_argument('--webhook-port', type=int, default=8080, metavar='PORT',
+                      help='local port to serve webhook requests on '
+                           '(put a TLS reverse proxy in front)')
   parser.add_argument('--loglevel', default='info',
                       choices=['debug', 'info', 'warn', 'error'],
                       help='log level')
@@ -276,6 +410,9 @@ if __name__ == '__main__':
     rootlogger.addHandler(handler)
 
   try:
-    asyncio.run(main(token, args.storefile))
+    asyncio.run(main(
+      token, args.storefile,
+      args.webhook_url, args.webhook_port,
+    ))
   except KeyboardInterrupt:
     pass
@@ -1,4 +1,4 @@
-from collections import UserDict
+from collections import UserDict, deque
 import time
 
 class ExpiringDict(UserDict):
@@ -6,6 +6,9 @@ class ExpiringDict(UserDict):
     super().__init__()
     self.default_ttl = default_ttl
     self.maxsize = maxsize
+    # (expire_at, key) in insertion order; re-set keys leave stale
+    # entries behind that expire() skips lazily
+    self._order = deque()
 
   def __getitem__(self, key):
     item, t = self.data[key]
@@ -17,20 +20,31 @@ class ExpiringDict(UserDict):
   def set_item(self, key, value, ttl=None):
     if ttl is None:
       ttl = self.default_ttl
-    t = time.time() + ttl
+    t = time.monotonic() + ttl
     self.data[key] = value, t
+    self._order.append((t, key))
 
   def __delitem__(self, key):
     del self.data[key]
 
+  def __contains__(self, key):
+    # honours expiry without triggering a full sweep
+    item = self.data.get(key)
+    return item is not None and item[1] >= time.monotonic()
+
   def expire(self):
-    now = time.time()
-    expired_keys = [k for k, (_, t) in self.data.items() if t < now]
-    for k in expired_keys:
-      del self.data[k]
-
-    if len(self.data) > self.maxsize:
-      keys = [k for k, _ in sorted(self.data.items(), key=lambda x: x[1][1])]
-      overflowed = keys[-self.maxsize:]
-      for k in overflowed:
-        del self.data[k]
+    now = time.monotonic()
+    data = self.data
+    order = self._order
+    while order and order[0][0] <= now:
+      t, k = order.popleft()
+      item = data.get(k)
+      if item is not None and item[1] == t:
+        del data[k]
+
+    # evict the oldest entries when oversized
+    while len(data) > self.maxsize:
+      t, k = order.popleft()
+      item = data.get(k)
+      if item is not None and item[1] == t:
+        del data[k]
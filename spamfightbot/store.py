@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import shelve
+import sqlite3
+from dbm import whichdb
+from typing import Optional, Union
+
+logger = logging.getLogger(__name__)
+
+def _load_legacy_pairs(path: str) -> Optional[dict[int, int]]:
+  '''Read a pre-sqlite shelve store at path and move its files aside.
+
+  Returns the group->front pairs it held, or None if there is no
+  legacy store (including when path is already an sqlite database,
+  which whichdb doesn't recognize).
+  '''
+  if not whichdb(path):
+    return None
+  with shelve.open(path, 'r') as old:
+    pairs = {int(k): v for k, v in old.items() if isinstance(v, int)}
+  # dbm backends use various file layouts; rename whatever is there
+  # so sqlite can take over the name
+  for f in (path, path + '.db', path + '.dat', path + '.dir',
+            path + '.bak', path + '.pag'):
+    if os.path.exists(f):
+      os.rename(f, f + '.pre-sqlite')
+  return pairs
+
+class ConfigStore:
+  '''sqlite-backed replacement for the old shelve store.
+
+  Maps protected group ids to their front (gate) chat ids. WAL mode
+  keeps writes cheap and lets reads proceed without blocking. A
+  shelve store from older versions is migrated on first open.
+  '''
+
+  def __init__(self, path: str) -> None:
+    legacy = _load_legacy_pairs(path)
+    db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    try:
+      db.execute('PRAGMA journal_mode=WAL')
+    except sqlite3.DatabaseError as e:
+      raise sqlite3.DatabaseError(
+        f'{path} is neither an sqlite database nor a readable old-style '
+        'store; move it away or convert it by hand') from e
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute('PRAGMA busy_timeout=60000')
+    db.execute('''
+      CREATE TABLE IF NOT EXISTS pairs (
+        group_id INTEGER PRIMARY KEY,
+        front_id INTEGER NOT NULL
+      )''')
+    if legacy:
+      logger.info('migrating %d pair(s) from the old shelve store', len(legacy))
+      db.executemany(
+        'INSERT OR REPLACE INTO pairs (group_id, front_id) VALUES (?, ?)',
+        legacy.items(),
+      )
+    self._db = db
+
+  def __getitem__(self, key: Union[int, str]) -> int:
+    row = self._db.execute(
+      'SELECT front_id FROM pairs WHERE group_id=?', (int(key),),
+    ).fetchone()
+    if row is None:
+      raise KeyError(key)
+    return row[0]
+
+  def get(self, key: Union[int, str], default: Optional[int] = None) -> Optional[int]:
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def __setitem__(self, key: Union[int, str], value: int) -> None:
+    self._db.execute(
+      'INSERT OR REPLACE INTO pairs (group_id, front_id) VALUES (?, ?)',
+      (int(key), value),
+    )
+
+  def __delitem__(self, key: Union[int, str]) -> None:
+    cur = self._db.execute('DELETE FROM pairs WHERE group_id=?', (int(key),))
+    if cur.rowcount == 0:
+      raise KeyError(key)
+
+  def pop(self, key: Union[int, str], default: Optional[int] = None) -> Optional[int]:
+    try:
+      value = self[key]
+    except KeyError:
+      return default
+    self._db.execute('DELETE FROM pairs WHERE group_id=?', (int(key),))
+    return value
+
+  # writes hit the disk; run them in a thread so handlers awaiting
+  # other things aren't stalled behind the fsync
+  async def set(self, key: Union[int, str], value: int) -> None:
+    await asyncio.to_thread(self.__setitem__, key, value)
+
+  async def delete(self, key: Union[int, str]) -> None:
+    await asyncio.to_thread(self.pop, key, None)
+
+  def front_groups(self) -> set[int]:
+    return {row[0] for row in self._db.execute(
+      'SELECT DISTINCT front_id FROM pairs')}
+
+  def close(self) -> None:
+    self._db.close()
+
+  def __enter__(self) -> ConfigStore:
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.close()